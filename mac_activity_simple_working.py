@@ -8,14 +8,78 @@ import tkinter as tk
 from tkinter import ttk, messagebox, scrolledtext, simpledialog
 import subprocess
 import re
+import queue
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from matplotlib.patches import Rectangle
+from matplotlib.patches import Rectangle, Patch
+from matplotlib.collections import PatchCollection
 from collections import defaultdict
+from itertools import islice
+import heapq
+from bisect import bisect_left, bisect_right
 import json
 import os
 
+# --- Konstanty ---
+# Názvy dnů odpovídají `%A` ve výchozím locale; formátování přes tabulku je rychlejší než strftime
+WEEKDAYS = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+
+# Barvy stavů v heatmapě a styl (emoji, popisek) událostí v záložce Spánek
+STATE_COLORS = {'active': '#2ecc71', 'sleep': '#95a5a6', 'unknown': '#ecf0f1'}
+SLEEP_EVENT_STYLE = {'sleep': ('😴', 'Sleep'), 'wake': ('⏰', 'Wake')}
+
+# Stav, do kterého přepne daný typ události; ostatní typy stav nemění
+EVENT_STATE = {
+    'wake': 'active', 'display_on': 'active', 'active_start': 'active',
+    'sleep': 'sleep', 'display_off': 'sleep',
+}
+
+# --- Pomocné funkce ---
+def _json_default(obj):
+    """Převede datetime na ISO řetězec; volá ho JSON encoder pro neznámé typy."""
+    if isinstance(obj, datetime): return obj.isoformat()
+    raise TypeError(f"Objekt typu {type(obj).__name__} nelze serializovat do JSON")
+
+def _format_day(day):
+    """Naformátuje datum jako `strftime('%A %d.%m.%Y')`."""
+    return f"{WEEKDAYS[day.weekday()]} {day.day:02d}.{day.month:02d}.{day.year:04d}"
+
+def _parse_timestamp(ts):
+    """Rychlá náhrada `strptime(ts, '%Y-%m-%d %H:%M:%S')` pro pevný formát razítka."""
+    return datetime(int(ts[0:4]), int(ts[5:7]), int(ts[8:10]), int(ts[11:13]), int(ts[14:16]), int(ts[17:19]))
+
+def _line_timestamp(line):
+    """Vrátí razítko `YYYY-MM-DD HH:MM:SS` ze začátku řádku logu, nebo None.
+
+    `pmset -g log` i `log show --style syslog` píší razítko vždy na pozici 0..19,
+    stačí tedy ověřit oddělovače a číslice na pevných pozicích místo spouštění regexu.
+    """
+    if (len(line) >= 19 and line[4] == '-' and line[7] == '-' and line[10] == ' '
+            and line[13] == ':' and line[16] == ':'
+            and (line[0:4] + line[5:7] + line[8:10] + line[11:13] + line[14:16] + line[17:19]).isdecimal()):
+        return line[:19]
+    return None
+
+def _power_event_type(line):
+    """Určí typ události z řádku výstupu `pmset -g log`, nebo None pro nezajímavé řádky.
+
+    Hledá se až za razítkem (od pozice 20), prvních 19 znaků klíčová slova obsahovat nemůže.
+    """
+    if line.find('Sleep', 20) != -1: return 'sleep'
+    if line.find('Wake', 20) != -1: return 'wake'
+    if line.find('Display', 20) == -1: return None
+    if line.find('Display is turned on', 20) != -1: return 'display_on'
+    if line.find('Display is turned off', 20) != -1: return 'display_off'
+    return 'unknown'
+
+def _naive_seconds(dt):
+    """Převede naivní datetime na celé sekundy pro rychlé porovnávání (bez časových pásem)."""
+    return dt.toordinal() * 86400 + dt.hour * 3600 + dt.minute * 60 + dt.second
+
 # --- Konfigurační manažer ---
 class ConfigManager:
     """Spravuje načítání a ukládání nastavení z JSON souboru."""
@@ -62,11 +126,28 @@ class MacActivityAnalyzer:
         self.power_events = []
         self.app_events = []
         self.states = []
+        self.state_totals = defaultdict(float)  # součet trvání (s) podle typu stavu
         self.app_usage = defaultdict(lambda: {'sessions': [], 'duration': 0})
+
+        # Sběr dat běží ve vlákně na pozadí, se GUI komunikuje přes frontu zpráv.
+        # Vlákno pracuje jen s lokálními daty, do self.* je přiřadí až poll_analysis v Tk vlákně.
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._messages = queue.Queue()
+        self._analysis_future = None
+        self._rerun_requested = False
+        # Běžící podprocesy (`pmset`, `log`, `grep`), aby je šlo při zavření okna ukončit
+        self._children = set()
+        self._children_lock = threading.Lock()
+        self._closing = False
+        self.heatmap_canvas = None
+        self._events_signature = None
+        self._app_events_key = None  # seznam aplikací, pro který platí self.app_events
         
         # GUI
         self.setup_ui()
         
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+
         # Automatické spuštění analýzy
         self.root.after(100, self.analyze_activity)
         
@@ -81,10 +162,33 @@ class MacActivityAnalyzer:
             frame = ttk.Frame(self.notebook)
             self.notebook.add(frame, text=name)
             self.tabs[name] = frame
+        self.setup_settings_tab()
+
+        # Záložky s daty se překreslují líně: po analýze jen viditelná, ostatní až při přepnutí
+        self._tab_updaters = {
+            "📊 Graf aktivity": self.update_graph_tab,
+            "📱 Aplikace": self.update_apps_tab,
+            "😴 Spánek": self.update_sleep_tab,
+            "📈 Statistiky": self.update_stats_tab,
+            "🕒 Timeline": self.update_timeline_tab,
+            "💰 Finance": self.update_finance_tab,
+        }
+        self._dirty_tabs = set()
+        self.notebook.bind('<<NotebookTabChanged>>', self.refresh_current_tab)
+
+        # Sazba žije mimo záložku Finance, aby ji šlo uložit i bez jejího vykreslení
+        self.rate_var = tk.StringVar(value=str(self.config_manager.config.get("hourly_rate", 250)))
+        # Sazba se parsuje jen při změně pole, ne při každém přepočtu
+        self.rate_var.trace_add('write', self.on_rate_change)
+        self.on_rate_change()
 
         self.status_var = tk.StringVar(value="Připraven k analýze")
-        status_bar = ttk.Label(self.root, textvariable=self.status_var, relief=tk.SUNKEN, anchor='w')
-        status_bar.pack(fill='x', side='bottom', padx=5, pady=2)
+        status_frame = ttk.Frame(self.root)
+        status_frame.pack(fill='x', side='bottom', padx=5, pady=2)
+        status_bar = ttk.Label(status_frame, textvariable=self.status_var, relief=tk.SUNKEN, anchor='w')
+        status_bar.pack(fill='x', side='left', expand=True)
+        self.progress = ttk.Progressbar(status_frame, mode='indeterminate', length=150)
+        self.progress.pack(side='right', padx=(5, 0))
         
         button_frame = ttk.Frame(self.root)
         button_frame.pack(fill='x', padx=5, pady=5)
@@ -92,231 +196,419 @@ class MacActivityAnalyzer:
         ttk.Button(button_frame, text="💾 Exportovat data", command=self.export_data).pack(side='left', padx=2)
     
     def analyze_activity(self):
-        """Hlavní metoda pro spuštění celé analýzy."""
+        """Hlavní metoda pro spuštění celé analýzy. Data se sbírají na pozadí."""
+        if self._analysis_running():
+            # Nová analýza se nezahazuje, spustí se hned po dokončení té běžící
+            self._rerun_requested = True
+            self.status_var.set("Analýza už běží, nová se spustí po jejím dokončení...")
+            return
+
+        # Vlákno dostane snímek konfigurace a předchozích událostí, na self.* pak nesahá
+        config = self.config_manager.config
         self.status_var.set("Zahajuji analýzu aktivity za posledních 10 dní...")
-        self.root.update_idletasks()
+        self.progress.start(10)
+        self._analysis_future = self._executor.submit(
+            self.collect_data, list(config.get("monitored_apps", [])), config.get("session_timeout_minutes", 30),
+            self.app_events, self._app_events_key)
+        self._poll_idle_ticks = 0
+        self.root.after(100, self.poll_analysis)
+
+    def _analysis_running(self):
+        return self._analysis_future is not None and not self._analysis_future.done()
+
+    def collect_data(self, monitored_apps, session_timeout_minutes, cached_app_events, cached_apps_key):
+        """Získá a zpracuje data. Běží ve vlákně, proto nesahá na GUI ani na self.* a výsledky vrací."""
+        # Jeden okamžik „teď“ pro celý běh: filtr okna i konec posledního stavu pak sedí přesně
+        now = datetime.now()
+        # `pmset` a `log show` jsou nezávislé a většinu času čekají na podproces, běží proto souběžně
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            power_future = pool.submit(self.get_power_events, now)
+            app_events, apps_key = self.get_app_events(now, monitored_apps, cached_app_events, cached_apps_key)
+            power_events = power_future.result()
+        app_usage = self.analyze_app_usage(app_events, session_timeout_minutes)
+        states, state_totals = self.calculate_states(power_events, app_usage, now)
+        return power_events, app_events, apps_key, app_usage, states, state_totals
+
+    @contextmanager
+    def _child_process(self, *args, **kwargs):
+        """Spustí podproces a po dobu jeho běhu ho eviduje, aby ho šlo při zavření okna zabít."""
+        with subprocess.Popen(*args, **kwargs) as proc:
+            with self._children_lock:
+                self._children.add(proc)
+                if self._closing: proc.kill()
+            try:
+                yield proc
+            finally:
+                with self._children_lock:
+                    self._children.discard(proc)
+
+    def on_close(self):
+        """Zavře okno; běžící podprocesy zabije, aby na ně ukončení programu nečekalo."""
+        with self._children_lock:
+            self._closing = True
+            for proc in self._children:
+                proc.kill()
+        self._executor.shutdown(wait=False)
+        self.root.destroy()
+
+    def poll_analysis(self):
+        """Předá zprávy z vlákna analýzy do GUI a po jejím skončení obnoví záložky."""
+        done = self._analysis_future.done()
+        received = False
+        status = None
+        errors = []
+        while True:
+            try:
+                kind, *payload = self._messages.get_nowait()
+            except queue.Empty:
+                break
+            received = True
+            if kind == 'status':
+                status = payload[0]  # starší stavové zprávy z téže dávky by uživatel stejně neviděl
+            elif kind == 'error':
+                errors.append(payload)
+        if status is not None:
+            self.status_var.set(status)
+        # Chyby z jedné dávky (např. selhal `pmset` i `log show`) se ukážou v jediném dialogu
+        if len(errors) == 1:
+            messagebox.showerror(*errors[0])
+        elif errors:
+            messagebox.showerror("Chyby při analýze", "\n\n".join(f"{title}: {text}" for title, text in errors))
+
+        if not done:
+            # Dokud nechodí zprávy (např. dlouhý `log show`), interval se prodlužuje až na 1 s
+            self._poll_idle_ticks = 0 if received else min(self._poll_idle_ticks + 1, 4)
+            self.root.after(min(1000, 100 << self._poll_idle_ticks), self.poll_analysis)
+            return
 
-        self.get_power_events()
-        self.get_app_events()
-        self.analyze_app_usage()
-        self.calculate_states()
-        
+        self.progress.stop()
+        error = self._analysis_future.exception()
+        if error is not None:
+            messagebox.showerror("Neočekávaná chyba", f"Analýza selhala: {error}")
+            self.status_var.set("Analýza selhala.")
+        else:
+            (self.power_events, self.app_events, self._app_events_key,
+             self.app_usage, self.states, self.state_totals) = self._analysis_future.result()
+            self.update_tabs()
+
+        # Analýza vyžádaná během běhu (tlačítko, uložení nastavení) se spustí až teď
+        if self._rerun_requested:
+            self._rerun_requested = False
+            self.analyze_activity()
+
+    def update_tabs(self):
+        """Překreslí všechny záložky podle aktuálně spočítaných dat."""
         self.status_var.set("Aktualizuji uživatelské rozhraní...")
         self.root.update_idletasks()
         
-        self.update_graph_tab()
-        self.update_apps_tab()
-        self.update_sleep_tab()
-        self.update_stats_tab()
-        self.update_timeline_tab()
-        self.update_finance_tab()
-        self.setup_settings_tab()
+        # Graf, statistiky a finance závisí i na aktuálním čase (poslední stav končí „teď“),
+        # ostatní záložky jen na událostech – ty se překreslí, pouze pokud se události změnily
+        events_signature = hash((
+            tuple((e['time'], e['description']) for e in self.power_events),
+            tuple((e['time'], e['app']) for e in self.app_events),
+            self.config_manager.config.get("session_timeout_minutes", 30),
+        ))
+        events_changed = events_signature != self._events_signature
+        self._events_signature = events_signature
+
+        self._dirty_tabs.update(("📊 Graf aktivity", "📈 Statistiky", "💰 Finance"))
+        if events_changed:
+            self._dirty_tabs.update(("📱 Aplikace", "😴 Spánek", "🕒 Timeline"))
+        self.refresh_current_tab()
+        self.refresh_settings_tab()
         
         self.status_var.set(f"Analýza dokončena. Zpracováno {len(self.app_events)} aplikačních a {len(self.power_events)} power událostí.")
 
-    def get_power_events(self):
-        """Získá události spánku/probuzení z `pmset`."""
-        self.status_var.set("Získávám data o spánku a probuzení...")
-        self.root.update_idletasks()
+    def refresh_current_tab(self, event=None):
+        """Překreslí právě zobrazenou záložku, pokud má zastaralý obsah."""
+        tab_name = self.notebook.tab(self.notebook.select(), 'text')
+        if tab_name in self._dirty_tabs:
+            self._dirty_tabs.discard(tab_name)
+            self._tab_updaters[tab_name]()
+
+    def get_power_events(self, now):
+        """Získá události spánku/probuzení z `pmset`. Vrací je seřazené, při chybě prázdný seznam."""
+        self._messages.put(('status', "Získávám data o spánku a probuzení..."))
         try:
-            cmd = "pmset -g log | grep -E '(Sleep|Wake|Display)'"
-            result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-            
-            self.power_events = []
-            ten_days_ago = datetime.now() - timedelta(days=10)
+            ten_days_ago = now - timedelta(days=10)
+            # Více událostí často sdílí stejnou sekundu; razítko se pak parsuje jen jednou
+            ts_cache = {}
             
-            for line in result.stdout.split('\n'):
-                if not line.strip(): continue
-                match = re.search(r'(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})', line)
-                if match:
-                    timestamp = datetime.strptime(match.group(1), '%Y-%m-%d %H:%M:%S')
+            # Jediný proces bez shellu a grepu. Výstup se čte průběžně po řádcích a filtruje
+            # v Pythonu, takže se celý (i mnohamegabajtový) log nikdy nedrží v paměti
+            power_events = []
+            with self._child_process(['pmset', '-g', 'log'], stdout=subprocess.PIPE, text=True) as proc:
+                for line in proc.stdout:
+                    ts = _line_timestamp(line)
+                    if not ts: continue
+
+                    event_type = _power_event_type(line)
+                    if not event_type: continue
+
+                    timestamp = ts_cache.get(ts)
+                    if timestamp is None:
+                        timestamp = ts_cache[ts] = _parse_timestamp(ts)
+
                     if timestamp >= ten_days_ago:
-                        event_type = 'unknown'
-                        if 'Sleep' in line: event_type = 'sleep'
-                        elif 'Wake' in line: event_type = 'wake'
-                        elif 'Display is turned on' in line: event_type = 'display_on'
-                        elif 'Display is turned off' in line: event_type = 'display_off'
-                        self.power_events.append({'time': timestamp, 'type': event_type, 'description': line.strip()})
+                        power_events.append({'time': timestamp, 'type': event_type, 'description': line.strip()})
             
-            self.power_events.sort(key=lambda x: x['time'])
+            power_events.sort(key=lambda x: x['time'])
+            return power_events
         except Exception as e:
-            messagebox.showerror("Chyba `pmset`", f"Nepodařilo se získat data o napájení: {e}")
+            self._messages.put(('error', "Chyba `pmset`", f"Nepodařilo se získat data o napájení: {e}"))
+            return []
 
-    def get_app_events(self):
-        """Získá události aplikací z `log show` (OPRAVENÁ, ROBUSTNĚJŠÍ VERZE)."""
-        self.status_var.set("Získávám data o spuštěných aplikacích (může trvat)...")
-        self.root.update_idletasks()
+    def get_app_events(self, now, monitored_apps, cached_events, cached_key):
+        """Získá události aplikací z `log show` (OPRAVENÁ, ROBUSTNĚJŠÍ VERZE).
+
+        Vrací dvojici (události, klíč seznamu aplikací). Při opakované analýze se stejným
+        seznamem aplikací se čte jen nová část logu od poslední známé události, starší
+        události se převezmou z předchozího běhu. Při chybě se vrátí předchozí události.
+        """
+        self._messages.put(('status', "Získávám data o spuštěných aplikacích (může trvat)..."))
         try:
-            monitored_apps = self.config_manager.config.get("monitored_apps", [])
             if not monitored_apps:
-                self.app_events = []
                 print("Žádné aplikace ke sledování v konfiguraci.")
-                return
+                return [], None
+
+            # Log je jen přírůstkový: stačí dočíst úsek od poslední známé události. Události
+            # z její sekundy se zahodí a načtou znovu, aby se žádná neztratila ani nezdvojila.
+            # Je-li poslední známá událost starší než 10denní okno, čte se celé okno znovu.
+            ten_days_ago = now - timedelta(days=10)
+            apps_key = tuple(monitored_apps)
+            if apps_key == cached_key and cached_events and cached_events[-1]['time'] >= ten_days_ago:
+                resume_time = cached_events[-1]['time']
+                kept_events = [e for e in cached_events if e['time'] < resume_time]
+                range_args = ['--start', str(resume_time)]
+            else:
+                kept_events = []
+                range_args = ['--last', '10d']
 
             pattern = "|".join(re.escape(app) for app in monitored_apps)
-            cmd = f"""log show --last 10d --predicate 'eventMessage contains "launched" OR eventMessage contains "terminated" OR processImagePath contains ".app"' --style syslog | grep -iE '({pattern})'"""
-            
-            result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-            
-            if result.returncode > 1:
-                raise subprocess.CalledProcessError(result.returncode, cmd, output=result.stdout, stderr=result.stderr)
+            log_cmd = ['log', 'show', *range_args,
+                       '--predicate', 'eventMessage contains "launched" OR eventMessage contains "terminated" OR processImagePath contains ".app"',
+                       '--style', 'syslog']
+            # -w: grep propustí jen celá slova, stejně jako \b v app_re níže – méně řádků pro Python
+            grep_cmd = ['grep', '-iwE', f'({pattern})']
 
-            self.app_events = []
             app_name_map = {app.lower(): app for app in monitored_apps}
-
-            lines_to_process = result.stdout.split('\n')
-            if len(lines_to_process) > 20000:
-                 print(f"Varování: Nalezeno velké množství logů ({len(lines_to_process)} řádků), zpracování může být pomalejší.")
-
-            for line in lines_to_process:
-                if not line.strip(): continue
-                
-                match_time = re.search(r'(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})', line)
-                if not match_time: continue
-                
-                timestamp = datetime.strptime(match_time.group(1), '%Y-%m-%d %H:%M:%S')
-
-                found_app = None
-                for app_lower, app_original in app_name_map.items():
-                    if re.search(r'\b' + re.escape(app_lower) + r'\b', line.lower()):
-                        found_app = app_original
-                        break
-                
-                if found_app:
-                    self.app_events.append({'time': timestamp, 'app': found_app, 'type': 'active'})
-            
-            self.app_events.sort(key=lambda x: x['time'])
-            print(f"Nalezeno {len(self.app_events)} relevantních aplikačních událostí.")
+            # Jediný regex s alternací všech aplikací (delší názvy první) najde kandidáty v jednom
+            # průchodu. Při více shodách na řádku vyhrává aplikace dřívější v konfiguraci.
+            app_rank = {app_lower: i for i, app_lower in enumerate(app_name_map)}
+            app_re = re.compile(r'\b(?:' + '|'.join(re.escape(app_lower) for app_lower in sorted(app_name_map, key=len, reverse=True)) + r')\b')
+            app_patterns = [(app_lower, re.compile(r'\b' + re.escape(app_lower) + r'\b')) for app_lower in app_name_map]
+
+            # Roura `log | grep` se skládá přímo z procesů, bez mezilehlého /bin/sh.
+            # Výstup grepu se zpracovává průběžně po řádcích, celý se nikdy nedrží v paměti.
+            app_events = []
+            line_count = 0
+            ts_cache = {}  # stejné razítko se opakuje u všech řádků zalogovaných v jedné sekundě
+            with self._child_process(log_cmd, stdout=subprocess.PIPE) as log_proc, \
+                 self._child_process(grep_cmd, stdin=log_proc.stdout, stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE, text=True, bufsize=1 << 16) as grep_proc:
+                log_proc.stdout.close()  # grep je jediný čtenář; `log` tak dostane SIGPIPE, pokud grep skončí
+
+                for line in grep_proc.stdout:
+                    line_count += 1
+                    ts = _line_timestamp(line)
+                    if not ts: continue
+                    
+                    timestamp = ts_cache.get(ts)
+                    if timestamp is None:
+                        timestamp = ts_cache[ts] = _parse_timestamp(ts)
+
+                    line_lower = line.lower()
+                    found = app_re.findall(line_lower)
+                    if found:
+                        best = min(app_rank[app_lower] for app_lower in found)
+                        # Alternace spotřebuje delší nebo překrývající se shodu dřív, než zkusí kratší
+                        # název („code“ ve „visual studio code“); dřívější aplikace se proto ověří zvlášť
+                        for rank, (app_lower, app_pattern) in enumerate(islice(app_patterns, best)):
+                            if app_lower in line_lower and app_pattern.search(line_lower):
+                                best = rank
+                                break
+                        found_app = app_name_map[app_patterns[best][0]]
+                        app_events.append({'time': timestamp, 'app': found_app, 'type': 'active'})
+
+                grep_stderr = grep_proc.stderr.read()
+
+            if grep_proc.returncode > 1:
+                raise subprocess.CalledProcessError(grep_proc.returncode, grep_cmd, stderr=grep_stderr)
+
+            if line_count > 20000:
+                 print(f"Varování: Nalezeno velké množství logů ({line_count} řádků), zpracování může být pomalejší.")
+
+            app_events.sort(key=lambda x: x['time'])
+            # Z převzatých událostí se odříznou ty, které mezitím vypadly z 10denního okna
+            # (bisect nad zvláštním seznamem časů – parametr key má bisect až od Pythonu 3.10)
+            cut = bisect_left([e['time'] for e in kept_events], ten_days_ago)
+            app_events = kept_events[cut:] + app_events
+            print(f"Nalezeno {len(app_events)} relevantních aplikačních událostí.")
+            return app_events, apps_key
 
         except (subprocess.CalledProcessError, FileNotFoundError) as e:
-            messagebox.showerror("Chyba `log show`", f"Nepodařilo se získat data o aplikacích: {e}")
+            self._messages.put(('error', "Chyba `log show`", f"Nepodařilo se získat data o aplikacích: {e}"))
         except Exception as e:
-            messagebox.showerror("Neočekávaná chyba", f"Došlo k chybě při zpracování aplikačních logů: {e}")
+            self._messages.put(('error', "Neočekávaná chyba", f"Došlo k chybě při zpracování aplikačních logů: {e}"))
+        return cached_events, cached_key
 
-    def analyze_app_usage(self):
+    def analyze_app_usage(self, app_events, session_timeout_minutes):
         """Analyzuje dobu používání aplikací na základě session."""
-        self.app_usage = defaultdict(lambda: {'sessions': [], 'duration': 0})
-        if not self.app_events: return
+        app_usage = defaultdict(lambda: {'sessions': [], 'duration': 0})
+        if not app_events: return app_usage
 
         events_by_app = defaultdict(list)
-        for event in self.app_events:
+        for event in app_events:
             events_by_app[event['app']].append(event['time'])
 
-        session_timeout = timedelta(minutes=self.config_manager.config.get("session_timeout_minutes", 30))
+        session_timeout = timedelta(minutes=session_timeout_minutes)
+
+        session_tail = timedelta(minutes=5)  # session končí 5 minut po poslední události
 
         for app, timestamps in events_by_app.items():
-            if not timestamps: continue
-            
+            sessions = app_usage[app]['sessions']
             session_start = timestamps[0]
-            last_event_time = timestamps[0]
             
-            for i in range(1, len(timestamps)):
-                current_event_time = timestamps[i]
+            # Mezery se porovnávají přímo jako timedelta v C, bez převodu na sekundy
+            for last_event_time, current_event_time in zip(timestamps, islice(timestamps, 1, None)):
                 if (current_event_time - last_event_time) > session_timeout:
-                    session_end = last_event_time + timedelta(minutes=5)
-                    duration = (session_end - session_start).total_seconds()
-                    self.app_usage[app]['sessions'].append({'start': session_start, 'end': session_end})
-                    self.app_usage[app]['duration'] += duration
+                    sessions.append({'start': session_start, 'end': last_event_time + session_tail})
                     session_start = current_event_time
-                last_event_time = current_event_time
 
-            session_end = last_event_time + timedelta(minutes=5)
-            duration = (session_end - session_start).total_seconds()
-            self.app_usage[app]['sessions'].append({'start': session_start, 'end': session_end})
-            self.app_usage[app]['duration'] += duration
+            sessions.append({'start': session_start, 'end': timestamps[-1] + session_tail})
+            app_usage[app]['duration'] = sum((s['end'] - s['start']).total_seconds() for s in sessions)
+        return app_usage
+
+    def calculate_states(self, power_events, app_usage, now):
+        """Vypočítá stavy (aktivní, pauza, spánek) na základě událostí.
+
+        Vrací seznam stavů a součty jejich trvání podle typu stavu.
+        """
+        states = []
+        # Součty podle typu se počítají rovnou při tvorbě stavů, záložky je pak jen čtou
+        totals = defaultdict(float)
+        if not power_events and not app_usage: return states, totals
+
+        current_time = now - timedelta(days=10)
+
+        # Události mimo sledované okno se vyřadí předem, smyčka je pak nemusí přeskakovat.
+        # Power události i session každé aplikace jsou už seřazené, stačí je tedy slít (bez řazení)
+        window_start = current_time  # generátory se vyhodnocují líně, current_time se ve smyčce mění
+        window_events = (e for e in power_events if e['time'] >= window_start)
+        session_starts = [({'time': s['start'], 'type': 'active_start'} for s in app_data['sessions'] if s['start'] >= window_start)
+                          for app_data in app_usage.values()]
+        all_events = heapq.merge(window_events, *session_starts, key=lambda x: x['time'])
+
+        # Session všech aplikací sloučené do seřazených disjunktních intervalů: test „byla mezi
+        # dvěma událostmi nějaká session?“ je pak jedno binární hledání místo průchodu všemi session
+        active_starts, active_ends = [], []
+        for start, end in sorted((s['start'], s['end']) for app_data in app_usage.values() for s in app_data['sessions']):
+            if active_ends and start <= active_ends[-1]:
+                if end > active_ends[-1]: active_ends[-1] = end
+            else:
+                active_starts.append(start)
+                active_ends.append(end)
 
-    def calculate_states(self):
-        """Vypočítá stavy (aktivní, pauza, spánek) na základě událostí."""
-        self.states = []
-        all_events = self.power_events[:]
-        for app_data in self.app_usage.values():
-            for session in app_data['sessions']:
-                all_events.append({'time': session['start'], 'type': 'active_start'})
-        
-        all_events.sort(key=lambda x: x['time'])
-        
-        if not all_events: return
-
-        current_time = datetime.now() - timedelta(days=10)
         current_state = 'unknown'
 
         for event in all_events:
             event_time = event['time']
-            if event_time < current_time: continue
-
             duration = (event_time - current_time).total_seconds()
             if duration > 1:
-                # Pro stav mezi událostmi určíme, zda byl aktivní
-                is_active_in_between = False
-                for app_data in self.app_usage.values():
-                    for s in app_data['sessions']:
-                        if max(current_time, s['start']) < min(event_time, s['end']):
-                            is_active_in_between = True
-                            break
-                    if is_active_in_between: break
+                # Pro stav mezi událostmi určíme, zda byl aktivní: stačí poslední interval začínající
+                # před event_time, díky sloučení má ze všech takových nejpozdější konec
+                i = bisect_left(active_starts, event_time) - 1
+                is_active_in_between = i >= 0 and active_ends[i] > current_time
                 
                 state_type = 'active' if is_active_in_between else current_state
-                self.states.append({'start': current_time, 'end': event_time, 'type': state_type, 'duration': duration})
+                states.append({'start': current_time, 'end': event_time, 'type': state_type, 'duration': duration})
+                totals[state_type] += duration
 
-            if event['type'] in ['wake', 'display_on', 'active_start']:
-                current_state = 'active'
-            elif event['type'] in ['sleep', 'display_off']:
-                current_state = 'sleep'
-            
+            current_state = EVENT_STATE.get(event['type'], current_state)
             current_time = event_time
 
-        if current_time < datetime.now():
-            self.states.append({'start': current_time, 'end': datetime.now(), 'type': current_state, 'duration': (datetime.now() - current_time).total_seconds()})
+        if current_time < now:
+            duration = (now - current_time).total_seconds()
+            states.append({'start': current_time, 'end': now, 'type': current_state, 'duration': duration})
+            totals[current_state] += duration
+        return states, totals
 
     def clear_tab(self, tab_name):
         frame = self.tabs[tab_name]
         for widget in frame.winfo_children():
             widget.destroy()
 
-    def update_graph_tab(self):
-        self.clear_tab("📊 Graf aktivity")
+    def setup_graph_canvas(self):
+        """Vytvoří figuru heatmapy. Mřížka buněk je pevná, při obnově se mění jen barvy a popisky."""
         frame = self.tabs["📊 Graf aktivity"]
-        if not self.states:
-             ttk.Label(frame, text="Nebylo nalezeno dostatek dat pro vykreslení grafu.").pack(pady=50)
-             return
+        fig = Figure(figsize=(12, 8))
+        ax = fig.add_subplot()
 
-        fig, ax = plt.subplots(figsize=(12, 8))
-        colors = {'active': '#2ecc71', 'sleep': '#95a5a6', 'unknown': '#ecf0f1'}
-        ten_days_ago = (datetime.now() - timedelta(days=9)).replace(hour=0, minute=0, second=0, microsecond=0)
+        # Všechny buňky tvoří jedinou kolekci (jeden artist) místo 960 samostatných patchů
+        cells = [Rectangle((day_offset, hour + quarter/4), 0.95, 0.23)
+                 for day_offset in range(10) for hour in range(24) for quarter in range(4)]
+        self.heatmap_cells = PatchCollection(cells, facecolors=STATE_COLORS['unknown'], edgecolors='none')
+        ax.add_collection(self.heatmap_cells)
 
-        for day_offset in range(10):
-            current_date = ten_days_ago + timedelta(days=day_offset)
-            for hour in range(24):
-                for quarter in range(4):
-                    start_time = current_date.replace(hour=hour, minute=quarter*15)
-                    end_time = start_time + timedelta(minutes=15)
-                    state_color = colors['unknown']
-                    for state in self.states:
-                        if max(state['start'], start_time) < min(state['end'], end_time):
-                            state_color = colors.get(state['type'], colors['unknown'])
-                            break
-                    rect = Rectangle((day_offset, hour + quarter/4), 0.95, 0.23, facecolor=state_color, edgecolor='none')
-                    ax.add_patch(rect)
-        
         ax.set_xlim(-0.5, 9.5)
         ax.set_ylim(0, 24)
         ax.set_xticks(range(10))
-        ax.set_xticklabels([(ten_days_ago + timedelta(days=i)).strftime('%d.%m\n%a') for i in range(10)])
         ax.set_yticks(range(0, 25, 2))
         ax.set_yticklabels([f'{h:02d}:00' for h in range(0, 25, 2)])
         ax.set_ylabel('Hodina')
         ax.set_title('Heatmapa aktivity za posledních 10 dní', fontsize=14, fontweight='bold')
         ax.invert_yaxis()
-        
-        from matplotlib.patches import Patch
-        legend_elements = [Patch(facecolor=c, label=l.capitalize()) for l, c in colors.items()]
+
+        legend_elements = [Patch(facecolor=c, label=l.capitalize()) for l, c in STATE_COLORS.items()]
         ax.legend(handles=legend_elements, loc='upper left', bbox_to_anchor=(1.01, 1))
 
-        plt.tight_layout(rect=[0, 0, 0.9, 1])
-        canvas = FigureCanvasTkAgg(fig, master=frame)
-        canvas.draw()
-        canvas.get_tk_widget().pack(fill='both', expand=True)
-        plt.close(fig)
+        # Pevné okraje místo tight_layout, který kvůli měření textů vykresluje figuru navíc
+        fig.subplots_adjust(left=0.07, right=0.78, top=0.95, bottom=0.07)
+        self.heatmap_ax = ax
+        self.heatmap_canvas = FigureCanvasTkAgg(fig, master=frame)
+        self.heatmap_canvas.get_tk_widget().pack(fill='both', expand=True)
+
+    def update_graph_tab(self):
+        frame = self.tabs["📊 Graf aktivity"]
+        if not self.states:
+            self.clear_tab("📊 Graf aktivity")
+            self.heatmap_canvas = None
+            ttk.Label(frame, text="Nebylo nalezeno dostatek dat pro vykreslení grafu.").pack(pady=50)
+            return
+        if self.heatmap_canvas is None:
+            self.clear_tab("📊 Graf aktivity")
+            self.setup_graph_canvas()
+
+        colors = STATE_COLORS
+        ten_days_ago = (datetime.now() - timedelta(days=9)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+        # Hranice stavů se převedou na celé sekundy jednou, vnitřní smyčka pak jen porovnává čísla.
+        # Stavy jsou chronologické a nepřekrývají se, stav buňky se proto hledá půlením intervalu
+        state_starts = [_naive_seconds(s['start']) for s in self.states]
+        state_ends = [_naive_seconds(s['end']) for s in self.states]
+        state_colors = [colors.get(s['type'], colors['unknown']) for s in self.states]
+        first_day = ten_days_ago.toordinal() * 86400
+
+        # Pořadí barev odpovídá pořadí buněk v kolekci (den, hodina, čtvrthodina)
+        cell_colors = []
+        for day_offset in range(10):
+            day_start = first_day + day_offset * 86400
+            for hour in range(24):
+                for quarter in range(4):
+                    start_s = day_start + hour * 3600 + quarter * 900
+                    end_s = start_s + 900
+                    i = bisect_right(state_ends, start_s)
+                    if i < len(state_ends) and state_starts[i] < end_s:
+                        state_color = state_colors[i]
+                    else:
+                        state_color = colors['unknown']
+                    cell_colors.append(state_color)
+        self.heatmap_cells.set_facecolor(cell_colors)
+
+        self.heatmap_ax.set_xticklabels([f"{d.day:02d}.{d.month:02d}\n{WEEKDAYS[d.weekday()][:3]}"
+                                         for d in (ten_days_ago + timedelta(days=i) for i in range(10))])
+        # Vykreslení se odloží do nečinnosti Tk, kdy už je plátno umístěné a má finální velikost
+        self.heatmap_canvas.draw_idle()
 
     def update_apps_tab(self):
         self.clear_tab("📱 Aplikace")
@@ -342,20 +634,24 @@ class MacActivityAnalyzer:
         frame = self.tabs["😴 Spánek"]
         text = scrolledtext.ScrolledText(frame, wrap=tk.WORD)
         text.pack(fill='both', expand=True, padx=10, pady=10)
-        text.insert(tk.END, "ANALÝZA SPÁNKU ZA 10 DNÍ\n", ('title',))
+        # Text a tagy se sbírají do jednoho seznamu a vloží se jediným voláním insert
+        parts = ["ANALÝZA SPÁNKU ZA 10 DNÍ\n", ('title',)]
         
-        current_date = None
+        # Dny se rozlišují podle celočíselného ordinálu, bez vytváření objektů date
+        current_day = None
         for event in self.power_events:
-            if event['type'] not in ['sleep', 'wake']: continue
-            event_date = event['time'].date()
-            if event_date != current_date:
-                current_date = event_date
-                text.insert(tk.END, f"\n{event_date.strftime('%A %d.%m.%Y')}\n", ('date',))
+            style = SLEEP_EVENT_STYLE.get(event['type'])
+            if style is None: continue
+            event_time = event['time']
+            day = event_time.toordinal()
+            if day != current_day:
+                current_day = day
+                parts += [f"\n{_format_day(event_time)}\n", ('date',)]
             
-            tag = 'sleep' if event['type'] == 'sleep' else 'wake'
-            emoji = '😴' if event['type'] == 'sleep' else '⏰'
-            text.insert(tk.END, f"  {emoji} {event['time'].strftime('%H:%M')} - {event['type'].capitalize()}\n", (tag,))
+            emoji, label = style
+            parts += [f"  {emoji} {event_time.hour:02d}:{event_time.minute:02d} - {label}\n", (event['type'],)]
         
+        text.insert(tk.END, *parts)
         text.tag_config('title', font=('Arial', 14, 'bold'))
         text.tag_config('date', font=('Arial', 12, 'bold'), foreground='blue')
         text.tag_config('sleep', foreground='gray')
@@ -368,8 +664,8 @@ class MacActivityAnalyzer:
         stats_frame = ttk.LabelFrame(frame, text="Celkové statistiky za 10 dní", padding=20)
         stats_frame.pack(fill='both', expand=True, padx=20, pady=20)
 
-        total_active = sum(s['duration'] for s in self.states if s['type'] == 'active') / 3600
-        total_sleep = sum(s['duration'] for s in self.states if s['type'] == 'sleep') / 3600
+        total_active = self.state_totals['active'] / 3600
+        total_sleep = self.state_totals['sleep'] / 3600
         
         stats = [
             ('Celkem aktivní:', f"{total_active:.1f} hodin"),
@@ -389,21 +685,27 @@ class MacActivityAnalyzer:
         text = scrolledtext.ScrolledText(frame, wrap=tk.WORD)
         text.pack(fill='both', expand=True, padx=10, pady=10)
 
-        all_events = self.power_events + self.app_events
-        all_events.sort(key=lambda x: x['time'], reverse=True)
+        # Obě řady událostí jsou seřazené vzestupně, takže stačí je slít od konce
+        # a vzít prvních 500 – bez kopírování a řazení celého seznamu
+        newest_events = heapq.merge(reversed(self.power_events), reversed(self.app_events),
+                                    key=lambda x: x['time'], reverse=True)
 
-        current_date = None
-        for event in all_events[:500]:
-            event_date = event['time'].date()
-            if event_date != current_date:
-                current_date = event_date
-                text.insert(tk.END, f"\n{event_date.strftime('%A %d.%m.%Y')}\n", ('date',))
+        parts = []
+        current_day = None
+        for event in islice(newest_events, 500):
+            event_time = event['time']
+            day = event_time.toordinal()
+            if day != current_day:
+                current_day = day
+                parts += [f"\n{_format_day(event_time)}\n", ('date',)]
             
-            time_str = event['time'].strftime('%H:%M:%S')
+            time_str = f"{event_time.hour:02d}:{event_time.minute:02d}:{event_time.second:02d}"
             desc = event.get('app', event.get('description', 'N/A'))
             tag = 'app' if 'app' in event else 'power'
-            text.insert(tk.END, f"{time_str} - {desc}\n", (tag,))
+            parts += [f"{time_str} - {desc}\n", (tag,)]
         
+        if parts:
+            text.insert(tk.END, *parts)
         text.tag_config('date', font=('Arial', 12, 'bold'), foreground='blue')
         text.tag_config('app', foreground='green')
         text.tag_config('power', foreground='orange')
@@ -417,7 +719,7 @@ class MacActivityAnalyzer:
         settings_frame.pack(fill='x', padx=20, pady=20)
         
         ttk.Label(settings_frame, text="Hodinová sazba (Kč):").grid(row=0, column=0, sticky='w')
-        self.rate_var = tk.StringVar(value=str(self.config_manager.config.get("hourly_rate", 250)))
+        self.rate_var.set(str(self.config_manager.config.get("hourly_rate", 250)))
         rate_entry = ttk.Entry(settings_frame, textvariable=self.rate_var, width=10)
         rate_entry.grid(row=0, column=1)
         ttk.Button(settings_frame, text="Přepočítat", command=self.calculate_finance).grid(row=0, column=2, padx=10)
@@ -426,29 +728,31 @@ class MacActivityAnalyzer:
         self.finance_result_frame.pack(fill='both', expand=True, padx=20, pady=10)
         self.calculate_finance()
 
-    def calculate_finance(self):
-        for widget in self.finance_result_frame.winfo_children(): widget.destroy()
+    def on_rate_change(self, *args):
+        """Uloží naparsovanou hodinovou sazbu; neplatný vstup nahradí sazbou z konfigurace."""
         try:
-            rate = float(self.rate_var.get())
+            self._hourly_rate = float(self.rate_var.get())
         except ValueError:
-            rate = self.config_manager.config.get("hourly_rate", 250)
+            self._hourly_rate = self.config_manager.config.get("hourly_rate", 250)
 
-        active_hours = sum(s['duration'] for s in self.states if s['type'] == 'active') / 3600
+    def calculate_finance(self):
+        for widget in self.finance_result_frame.winfo_children(): widget.destroy()
+        rate = self._hourly_rate
+
+        active_hours = self.state_totals['active'] / 3600
         total_czk = active_hours * rate
         
         ttk.Label(self.finance_result_frame, text=f"Aktivních hodin: {active_hours:.1f} h").pack(anchor='w')
         ttk.Label(self.finance_result_frame, text=f"Celkem za 10 dní: {total_czk:,.0f} Kč").pack(anchor='w')
 
     def setup_settings_tab(self):
-        self.clear_tab("⚙️ Nastavení")
+        """Vytvoří prvky záložky nastavení. Volá se jen jednou, při obnově se pouze načtou hodnoty."""
         frame = self.tabs["⚙️ Nastavení"]
         
         apps_frame = ttk.LabelFrame(frame, text="Sledované aplikace", padding=10)
         apps_frame.pack(fill='x', padx=10, pady=10)
 
         self.apps_listbox = tk.Listbox(apps_frame, height=10)
-        for app in self.config_manager.config.get("monitored_apps", []):
-            self.apps_listbox.insert(tk.END, app)
         self.apps_listbox.pack(side='left', fill='both', expand=True)
 
         apps_buttons_frame = ttk.Frame(apps_frame)
@@ -460,10 +764,18 @@ class MacActivityAnalyzer:
         other_frame.pack(fill='x', padx=10, pady=10)
         
         ttk.Label(other_frame, text="Timeout session (minuty):").grid(row=0, column=0, sticky='w')
-        self.session_timeout_var = tk.StringVar(value=str(self.config_manager.config.get("session_timeout_minutes", 30)))
+        self.session_timeout_var = tk.StringVar()
         ttk.Entry(other_frame, textvariable=self.session_timeout_var, width=10).grid(row=0, column=1)
 
         ttk.Button(frame, text="💾 Uložit nastavení a obnovit analýzu", command=self.save_settings).pack(pady=20)
+        self.refresh_settings_tab()
+
+    def refresh_settings_tab(self):
+        """Načte do existujících prvků záložky nastavení hodnoty z konfigurace."""
+        config = self.config_manager.config
+        self.apps_listbox.delete(0, tk.END)
+        self.apps_listbox.insert(tk.END, *config.get("monitored_apps", []))
+        self.session_timeout_var.set(str(config.get("session_timeout_minutes", 30)))
 
     def add_app(self):
         new_app = simpledialog.askstring("Přidat aplikaci", "Zadejte přesný název aplikace:")
@@ -489,7 +801,10 @@ class MacActivityAnalyzer:
             return
 
         self.config_manager.save_config(new_config)
-        messagebox.showinfo("Uloženo", "Nastavení bylo uloženo. Spouštím novou analýzu.")
+        if self._analysis_running():
+            messagebox.showinfo("Uloženo", "Nastavení bylo uloženo. Nová analýza se spustí po dokončení té běžící.")
+        else:
+            messagebox.showinfo("Uloženo", "Nastavení bylo uloženo. Spouštím novou analýzu.")
         self.analyze_activity()
 
     def export_data(self):
@@ -502,23 +817,30 @@ class MacActivityAnalyzer:
         )
         
         if not filename: return
-            
-        data = {
-            'exported_at': datetime.now().isoformat(),
-            'app_usage': self.app_usage,
-            'power_events': self.power_events,
-            'activity_states': self.states,
-        }
-        
-        def convert_dates(obj):
-            if isinstance(obj, dict): return {k: convert_dates(v) for k, v in obj.items()}
-            if isinstance(obj, list): return [convert_dates(item) for item in obj]
-            if isinstance(obj, datetime): return obj.isoformat()
-            return obj
-        
+
+        # Jeden sdílený encoder: encode() jde přes C akceleraci modulu json, json.dump() ne.
+        # Data se serializují přímo, datetime převádí až `default`, bez kopií záznamů
+        encoder = json.JSONEncoder(ensure_ascii=False, default=_json_default)
+
+        def write_list(f, key, items):
+            # Seznamy se zapisují položku po položce, aby v paměti nevznikla jejich kompletní kopie
+            f.write(f',\n  "{key}": [')
+            for i, item in enumerate(items):
+                if i: f.write(',')
+                f.write('\n    ')
+                f.write(encoder.encode(item))
+            f.write('\n  ]')
+
         try:
-            with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(convert_dates(data), f, indent=2, ensure_ascii=False)
+            # Velký buffer – export se skládá z mnoha malých zápisů
+            with open(filename, 'w', encoding='utf-8', buffering=1 << 20) as f:
+                f.write('{\n  "exported_at": ')
+                f.write(encoder.encode(datetime.now().isoformat()))
+                f.write(',\n  "app_usage": ')
+                f.write(encoder.encode(self.app_usage))
+                write_list(f, 'power_events', self.power_events)
+                write_list(f, 'activity_states', self.states)
+                f.write('\n}\n')
             messagebox.showinfo("Export", f"Data úspěšně exportována do:\n{filename}")
         except Exception as e:
             messagebox.showerror("Chyba exportu", f"Nepodařilo se exportovat data: {e}")